@@ -25,12 +25,17 @@ from skoolkit.skoolparser import (DIRECTIVES, parse_address_range, parse_asm_dat
                                   parse_asm_keep_directive, parse_asm_nowarn_directive,
                                   parse_asm_sub_fix_directive, read_skool)
 from skoolkit.textutils import partition_unquoted
+from skoolkit.z80 import Assembler
 
-VALID_CTLS = DIRECTIVES + ' *'
+VALID_CTLS = frozenset(DIRECTIVES + ' *')
+
+RELATIVE_JUMPS = ('DJNZ', 'JR')
 
 Entry = namedtuple('Entry', 'ctl instructions')
 
 class Instruction:
+    __slots__ = ('address', 'operation', 'sub', 'keep', 'nowarn', 'original', 'real_address', 'data', 'marker')
+
     def __init__(self, skool_address, address=None, operation=None, sub=False, keep=None, nowarn=None, data=None, marker=' '):
         self.address = skool_address # API (InstructionUtility)
         self.operation = operation   # API (InstructionUtility)
@@ -75,9 +80,24 @@ class BinWriter:
             'asm': asm_mode,
             'fix': fix_mode
         }
-        self.snapshot = [0] * 65536
+        self.directive_parsers = {
+            'isu': ('isub=', self._parse_sub_fix),
+            'ssu': ('ssub=', self._parse_sub_fix),
+            'rsu': ('rsub=', self._parse_sub_fix),
+            'ofi': ('ofix=', self._parse_sub_fix),
+            'bfi': ('bfix=', self._parse_sub_fix),
+            'rfi': ('rfix=', self._parse_sub_fix),
+            'if(': ('if(', self._parse_if),
+            'org': ('org', self._parse_org),
+            'kee': ('keep', self._parse_keep),
+            'now': ('nowarn', self._parse_nowarn),
+            'def': (('defb=', 'defs=', 'defw='), self._parse_data),
+            'rem': ('remote=', self._parse_remote)
+        }
+        self.snapshot = bytearray(65536)
         self.base_address = len(self.snapshot)
         self.end_address = 0
+        self.subs = defaultdict(list)
         self._reset(data)
         self.entry_ctl = None
         self.entries = []
@@ -85,11 +105,14 @@ class BinWriter:
         self.instructions = []
         self.address_map = {}
         self.assembler = get_assembler()
+        self.sizes = {}
+        self.cache_sizes = type(self.assembler) is Assembler
         self._parse_skool(skoolfile)
         self._relocate()
 
     def _reset(self, data):
-        self.subs = defaultdict(list, {0: []})
+        self.subs.clear()
+        self.max_weight = 0
         self.keep = None
         self.nowarn = None
         if data:
@@ -100,15 +123,18 @@ class BinWriter:
     def _parse_skool(self, skoolfile):
         f = open_file(skoolfile)
         address = None
+        parse_asm_directive = self._parse_asm_directive
+        parse_instruction = self._parse_instruction
         for non_entry, block in read_skool(f, 2, self.asm_mode, self.fix_mode):
             if non_entry:
                 continue
             removed = set()
             for line in block:
-                if line.startswith('@'):
-                    address = self._parse_asm_directive(address, line[1:], removed)
-                elif not line.lstrip().startswith(';') and line[0] in VALID_CTLS:
-                    address = self._parse_instruction(address, line, removed)
+                ctl = line[0]
+                if ctl == '@':
+                    address = parse_asm_directive(address, line[1:], removed)
+                elif ctl in VALID_CTLS and (ctl != ' ' or not line.lstrip().startswith(';')):
+                    address = parse_instruction(address, line, removed)
             self.entries.append(Entry(self.entry_ctl, self.instructions))
             self.entry_ctl = None
             self.instructions = []
@@ -125,23 +151,32 @@ class BinWriter:
             skool_address = None
         if address is None:
             address = skool_address
-        subbed = max(self.subs)
-        if subbed:
-            operations = self.subs[subbed]
-        else:
-            operations = ['']
         if skool_address not in removed:
-            original_op = partition_unquoted(line[6:], ';')[0].strip()
-            address = self._add_instructions(address, skool_address, operations, original_op, removed)
+            operation = line[6:]
+            if ';' in operation:
+                operation = partition_unquoted(operation, ';')[0]
+            original_op = operation.strip()
+            if self.max_weight:
+                address = self._add_instructions(address, skool_address, self.subs[self.max_weight], original_op, removed)
+            else:
+                address = self._add_instruction(address, skool_address, original_op)
         self._reset(self.data is not None)
         return address
 
+    def _add_instruction(self, address, skool_address, operation):
+        if skool_address not in self.address_map:
+            self.address_map[skool_address] = str(address)
+        if operation:
+            address += self._get_size(operation, address, ' ', sub=False, skool_address=skool_address)
+        return address
+
     def _add_instructions(self, address, skool_address, operations, original_op, removed):
         parsed = [parse_asm_sub_fix_directive(v)[::2] for v in operations]
         before = [i[1] for i in parsed if i[0].prepend and i[1]]
         for operation in before:
             address += self._get_size(operation, address, '>')
-        self.address_map.setdefault(skool_address, str(address))
+        if skool_address not in self.address_map:
+            self.address_map[skool_address] = str(address)
         after = [(i[0].overwrite, i[1], i[0].append) for i in parsed if not i[0].prepend]
         if skool_address is None:
             offset = 0
@@ -163,10 +198,14 @@ class BinWriter:
         return address
 
     def _get_size(self, operation, address, marker, overwrite=False, removed=None, offset=0, sub=True, skool_address=None):
-        if operation.upper().startswith(('DJNZ ', 'JR ')):
-            size = 2
-        else:
-            size = self.assembler.get_size(operation, address)
+        size = self.sizes.get(operation)
+        if size is None:
+            if operation.upper().startswith(('DJNZ ', 'JR ')):
+                size = 2
+            else:
+                size = self.assembler.get_size(operation, address)
+                if self.cache_sizes and operation.split(None, 1)[0].upper() not in RELATIVE_JUMPS:
+                    self.sizes[operation] = size
         if size:
             if overwrite:
                 removed.update(range(address + offset, address + offset + size))
@@ -177,62 +216,84 @@ class BinWriter:
         raise SkoolParsingError("Failed to assemble:\n {} {}".format(address, operation))
 
     def _parse_asm_directive(self, address, directive, removed):
-        if directive.startswith(('isub=', 'ssub=', 'rsub=', 'ofix=', 'bfix=', 'rfix=')):
-            value = directive[5:].rstrip()
-            if value.startswith('!'):
-                if self.weights[directive[:4]]:
-                    removed.update(parse_address_range(value[1:]))
-            else:
-                self.subs[self.weights[directive[:4]]].append(value)
-        elif directive.startswith('if('):
+        prefix, parser = self.directive_parsers.get(directive[:3], (None, None))
+        if parser and directive.startswith(prefix):
+            return parser(address, directive, removed)
+        return address
+
+    def _parse_sub_fix(self, address, directive, removed):
+        value = directive[5:].rstrip()
+        weight = self.weights[directive[:4]]
+        if value.startswith('!'):
+            if weight:
+                removed.update(parse_address_range(value[1:]))
+        else:
+            self.subs[weight].append(value)
+            if weight > self.max_weight:
+                self.max_weight = weight
+        return address
+
+    def _parse_if(self, address, directive, removed):
+        try:
+            return self._parse_asm_directive(address, parse_if(self.fields, directive, 2)[1], removed)
+        except MacroParsingError:
+            return address
+
+    def _parse_org(self, address, directive, removed):
+        org = directive.rstrip().partition('=')[2]
+        if org:
             try:
-                address = self._parse_asm_directive(address, parse_if(self.fields, directive, 2)[1], removed)
-            except MacroParsingError:
-                pass
-        elif directive.startswith('org'):
-            org = directive.rstrip().partition('=')[2]
-            if org:
-                try:
-                    address = get_int_param(org)
-                except ValueError:
-                    raise SkoolParsingError("Invalid org address: {}".format(org))
-            else:
-                address = None
-        elif directive.startswith('keep'):
-            self.keep = parse_asm_keep_directive(directive)
-        elif directive.startswith('nowarn'):
-            self.nowarn = parse_asm_nowarn_directive(directive)
-        elif self.data is not None and directive.startswith(('defb=', 'defs=', 'defw=')):
+                return get_int_param(org)
+            except ValueError:
+                raise SkoolParsingError("Invalid org address: {}".format(org))
+        return None
+
+    def _parse_keep(self, address, directive, removed):
+        self.keep = parse_asm_keep_directive(directive)
+        return address
+
+    def _parse_nowarn(self, address, directive, removed):
+        self.nowarn = parse_asm_nowarn_directive(directive)
+        return address
+
+    def _parse_data(self, address, directive, removed):
+        if self.data is not None:
             self.data.append(directive)
-        elif directive.startswith('remote='):
-            addrs = [parse_int(a) for a in directive[7:].partition(':')[-1].split(',')]
-            if addrs[0] is not None:
-                self.remote_entries.append(Entry(None, [Instruction(a) for a in addrs if a is not None]))
         return address
 
-    def _poke(self, instruction, data):
-        address = instruction.real_address
-        self.snapshot[address:address + len(data)] = data
-        self.base_address = min(self.base_address, address)
-        self.end_address = max(self.end_address, address + len(data))
-        if self.verbose:
-            info(str(instruction))
+    def _parse_remote(self, address, directive, removed):
+        addrs = [parse_int(a) for a in directive[7:].partition(':')[-1].split(',')]
+        if addrs[0] is not None:
+            self.remote_entries.append(Entry(None, [Instruction(a) for a in addrs if a is not None]))
+        return address
 
     def _warn(self, message, instruction):
-        if self.warn:
-            warn('{}:\n  {}'.format(message, instruction))
+        warn('{}:\n  {}'.format(message, instruction))
 
     def _relocate(self):
-        get_instruction_utility().substitute_labels(self.entries, self.remote_entries, self.address_map, self.asm_mode, self._warn)
+        if self.warn:
+            warn_f = self._warn
+        else:
+            warn_f = lambda message, instruction: None
+        get_instruction_utility().substitute_labels(self.entries, self.remote_entries, self.address_map, self.asm_mode, warn_f)
+        writes = []
         for entry in self.entries:
             for i in entry.instructions:
                 address = i.real_address
                 while i.data:
                     data_dir = i.data.pop(0)
                     address, data = parse_asm_data_directive(self.snapshot, address, data_dir, False)
-                    self._poke(Instruction(None, address, '@' + data_dir), data)
+                    writes.append((Instruction(None, address, '@' + data_dir), data))
                     address += len(data)
-                self._poke(i, self.assembler.assemble(i.operation, i.real_address))
+                writes.append((i, self.assembler.assemble(i.operation, i.real_address)))
+        for i, data in writes:
+            address = i.real_address
+            self.snapshot[address:address + len(data)] = data
+        if writes:
+            self.base_address = min(i.real_address for i, d in writes)
+            self.end_address = max(i.real_address + len(d) for i, d in writes)
+            if self.verbose:
+                info('\n'.join(str(i) for i, d in writes))
 
     def write(self, binfile):
         if self.start < 0:
@@ -244,9 +305,9 @@ class BinWriter:
         else:
             end_address = min(self.end, self.end_address)
         base_address = min(base_address, end_address)
-        data = self.snapshot[base_address:end_address]
+        data = memoryview(self.snapshot)[base_address:end_address]
         with open_file(binfile, 'wb') as f:
-            f.write(bytearray(data))
+            f.write(data)
         if binfile == '-':
             binfile = 'stdout'
         info("Wrote {}: start={}, end={}, size={}".format(binfile, base_address, end_address, len(data)))
@@ -14,15 +14,19 @@
 # You should have received a copy of the GNU General Public License along with
 # SkoolKit. If not, see <http://www.gnu.org/licenses/>.
 
+import re
 import sys
 import os
 
-from skoolkit import SkoolKitError, open_file, read_bin_file, write_line, get_address_format
+from skoolkit import SkoolKitError, open_file, read_bin_file, write_text, get_address_format
 from skoolkit.ctlparser import CtlParser
 from skoolkit.opcodes import END, decode
 from skoolkit.skoolctl import AD_ORG, AD_START
 from skoolkit.snaskool import Disassembly
 
+# The indexes of the bits that are set in each byte value
+BITS = tuple(tuple(i for i in range(8) if b & (1 << i)) for b in range(256))
+
 class CodeMapError(SkoolKitError):
     pass
 
@@ -44,20 +48,16 @@ def _get_code_blocks(snapshot, start, end, fname):
         data = read_bin_file(fname)
         address = start & 65528
         for b in data[start // 8:end // 8 + 1]:
-            for i in range(8):
-                if b & 1 and start <= address < end:
-                    addresses.append(address)
-                b >>= 1
-                address += 1
+            if b:
+                addresses.extend(address + i for i in BITS[b])
+            address += 8
+        addresses = [a for a in addresses if start <= a < end]
     elif size == 65536:
         # Assume this is a SpecEmu map file
         sys.stderr.write('Reading {}'.format(fname))
         sys.stderr.flush()
-        addresses = []
         data = read_bin_file(fname)
-        for address in range(start, end):
-            if data[address] & 1:
-                addresses.append(address)
+        addresses = [a for a in range(start, end) if data[a] & 1]
     else:
         sys.stderr.write('Reading {0}: '.format(fname))
         sys.stderr.flush()
@@ -77,10 +77,11 @@ def _get_code_blocks(snapshot, start, end, fname):
     return code_blocks
 
 def _get_addresses(f, fname, size, start, end):
-    addresses = set()
+    executed = bytearray(65536)
     base = 16
     i = 1
     rewind = True
+    address_slice = None
     ignore_prefixes = ()
 
     s_line = ''
@@ -95,20 +96,19 @@ def _get_addresses(f, fname, size, start, end):
 
     if s_line.startswith('0x'):
         # Fuse profile
-        address_f = lambda s_line: s_line[2:6]
+        address_slice = slice(2, 6)
     elif s_line.startswith('PC = '):
         # Spud log
-        address_f = lambda s_line: s_line[5:9]
+        address_slice = slice(5, 9)
     elif s_line.startswith('PC:'):
         # SpecEmu log
-        address_f = lambda s_line: s_line[:4]
-        ignore_prefixes = ('PC:', 'IX:', 'HL:', 'DE:', 'BC:', 'AF:')
+        address_slice = slice(4)
+        ignore_prefixes = frozenset(('PC:', 'IX:', 'HL:', 'DE:', 'BC:', 'AF:'))
         rewind = False
     elif s_line.endswith('decimal'):
         # Zero log
         if s_line.endswith('in decimal'):
             base = 10
-        address_f = lambda s_line: s_line[:s_line.find('\t')]
         rewind = False
     else:
         raise CodeMapError('{0}: Unrecognised format'.format(fname))
@@ -117,36 +117,60 @@ def _get_addresses(f, fname, size, start, end):
         f.seek(0)
         i = 1
 
+    progress = None
     while 1:
         line = f.readline()
         if not line:
             break
-        progress_msg = '{0}%'.format((100 * f.tell()) // size)
-        sys.stderr.write(progress_msg + chr(8) * len(progress_msg))
-        sys.stderr.flush()
+        if i % 4096 == 0:
+            progress = _show_progress(f, size, progress)
         s_line = line.strip()
         if s_line:
-            address_str = address_f(s_line)
+            if address_slice:
+                address_str = s_line[address_slice]
+            else:
+                address_str = s_line[:s_line.find('\t')]
             address = None
             if address_str:
                 try:
                     address = int(address_str, base)
                 except ValueError:
-                    if not (ignore_prefixes and s_line.startswith(ignore_prefixes)):
+                    if s_line[:3] not in ignore_prefixes:
                         raise CodeMapError('{0}, line {1}: Cannot parse address: {2}'.format(fname, i, s_line))
                 if address is not None:
                     if address < 0 or address > 65535:
                         raise CodeMapError('{0}, line {1}: Address out of range: {2}'.format(fname, i, s_line))
-                    if start <= address < end:
-                        addresses.add(address)
+                    executed[address] = 1
         i += 1
+    _show_progress(f, size, progress)
 
-    return sorted(addresses)
+    return [a for a in range(start, end) if executed[a]]
 
-def _find_terminal_instruction(snapshot, ctls, start, end, ctl=None):
+def _show_progress(f, size, progress):
+    percentage = (100 * f.tell()) // size
+    if percentage != progress:
+        progress_msg = '{0}%'.format(percentage)
+        sys.stderr.write(progress_msg + chr(8) * len(progress_msg))
+        sys.stderr.flush()
+    return percentage
+
+def _decode(snapshot, decoded, address):
+    instruction = decoded.get(address)
+    if instruction is None:
+        instruction = decoded[address] = next(decode(snapshot, address, address + 1))
+    return instruction
+
+def _is_terminated(snapshot, decoded, start, end):
     address = start
     while address < end:
-        i_addr, size, max_count, op_id = next(decode(snapshot, address, address + 1))[:4]
+        size, max_count, op_id = _decode(snapshot, decoded, address)[1:4]
+        address += size
+    return op_id == END
+
+def _find_terminal_instruction(snapshot, decoded, ctls, start, end, ctl=None):
+    address = start
+    while address < end:
+        i_addr, size, max_count, op_id = _decode(snapshot, decoded, address)[:4]
         address += size
         if ctl is None:
             for a in range(i_addr, address):
@@ -163,11 +187,8 @@ def _find_terminal_instruction(snapshot, ctls, start, end, ctl=None):
 
 def _get_blocks(ctls):
     # Determine the block start and end addresses
-    blocks = [[ctls[address], address, None] for address in sorted(ctls)]
-    for i, block in enumerate(blocks[1:]):
-        blocks[i][2] = block[1]
-    blocks.pop()
-    return blocks
+    addresses = sorted(ctls)
+    return [(ctls[a], a, b) for a, b in zip(addresses, addresses[1:])]
 
 def _generate_ctls_with_code_map(snapshot, start, end, config, code_map):
     # (1) Use the code map to create an initial set of 'c' ctls, and mark all
@@ -187,6 +208,7 @@ def _generate_ctls_with_code_map(snapshot, start, end, config, code_map):
     # (1) Mark all executed blocks as 'c' and unexecuted blocks as 'U'
     # (unknown)
     ctls = {start: 'U', end: 'i'}
+    decoded = {}
     for address, length in _get_code_blocks(snapshot, start, end, code_map):
         ctls[address] = 'c'
         if address + length < end:
@@ -194,21 +216,25 @@ def _generate_ctls_with_code_map(snapshot, start, end, config, code_map):
 
     # (2) Where a 'c' block doesn't end with a RET/JP/JR, extend it up to the
     # next RET/JP/JR in the following 'U' blocks, or up to the next 'c' block
+    terminated = {}
     while 1:
         done = True
         for ctl, b_start, b_end in _get_blocks(ctls):
             if ctl == 'c':
-                last_op_id = list(decode(snapshot, b_start, b_end))[-1][3]
-                if last_op_id == END:
+                block = (b_start, b_end)
+                if block not in terminated:
+                    terminated[block] = _is_terminated(snapshot, decoded, b_start, b_end)
+                if terminated[block]:
                     continue
-                if _find_terminal_instruction(snapshot, ctls, b_end, end) < end:
+                if _find_terminal_instruction(snapshot, decoded, ctls, b_end, end) < end:
                     done = False
                     break
         if done:
             break
 
     # (3) Mark entry points in 'U' blocks that are CALLed or JPed to from 'c'
-    # blocks with 'c'
+    # blocks with 'c' (every such block in the disassembly is marked before the
+    # disassembly is rebuilt to find any new entry points)
     ctl_parser = CtlParser(ctls)
     disassembly = Disassembly(snapshot, ctl_parser, final=False)
     while 1:
@@ -217,72 +243,72 @@ def _generate_ctls_with_code_map(snapshot, start, end, config, code_map):
         for entry in disassembly.entries:
             if entry.ctl == 'U':
                 for instruction in entry.instructions:
-                    for referrer in instruction.referrers:
-                        if ctls[referrer] == 'c':
-                            ctls[instruction.address] = 'c'
-                            if entry.next:
-                                e_end = entry.next.address
-                            else:
-                                e_end = 65536
-                            _find_terminal_instruction(snapshot, ctls, instruction.address, e_end, entry.ctl)
-                            disassembly.remove_entry(entry.address)
-                            done = False
-                            break
-                    if not done:
+                    if any(ctls[r] == 'c' for r in instruction.referrers):
+                        ctls[instruction.address] = 'c'
+                        if entry.next:
+                            e_end = entry.next.address
+                        else:
+                            e_end = 65536
+                        _find_terminal_instruction(snapshot, decoded, ctls, instruction.address, e_end, entry.ctl)
+                        disassembly.remove_entry(entry.address)
+                        done = False
                         break
-                if not done:
-                    break
         if done:
             break
 
     # (4) Split 'c' blocks on RET/JP/JR
     for ctl, b_address, b_end in _get_blocks(ctls):
         if ctl == 'c':
-            next_address = _find_terminal_instruction(snapshot, ctls, b_address, b_end, 'c')
+            next_address = _find_terminal_instruction(snapshot, decoded, ctls, b_address, b_end, 'c')
             if next_address < b_end:
                 disassembly.remove_entry(b_address)
                 while next_address < b_end:
-                    next_address = _find_terminal_instruction(snapshot, ctls, next_address, b_end, 'c')
+                    next_address = _find_terminal_instruction(snapshot, decoded, ctls, next_address, b_end, 'c')
 
     # (5) Scan the disassembly for pairs of adjacent blocks where the start
     # address of the second block is JRed or JPed to from the first block, and
-    # join such pairs
+    # join such pairs (after the first pass, only the blocks that were joined
+    # need to be examined again)
+    joined = None
     while 1:
         disassembly.build()
-        done = True
+        candidates = joined
+        joined = set()
         for entry in disassembly.entries[:-1]:
-            if entry.ctl == 'c':
+            if entry.ctl == 'c' and (candidates is None or entry.address in candidates):
+                next_address = str(entry.next.address)
                 for instruction in entry.instructions:
                     operation = instruction.operation
-                    if operation[:2] in ('JR', 'JP') and operation[-5:] == str(entry.next.address):
+                    if operation[:2] in ('JR', 'JP') and operation[-5:] == next_address:
                         del ctls[entry.next.address]
                         disassembly.remove_entry(entry.address)
                         disassembly.remove_entry(entry.next.address)
-                        done = False
+                        joined.add(entry.address)
                         break
-        if done:
+        if not joined:
             break
 
     # (6) Examine the 'U' blocks for text/data
+    mem = bytes(snapshot)
     for ctl, b_start, b_end in _get_blocks(ctls):
         if ctl == 'U':
             ctls[b_start] = 'b'
-            for t_start, t_end in _get_text_blocks(snapshot, b_start, b_end, config):
+            for t_start, t_end in _get_text_blocks(mem, b_start, b_end, config):
                 ctls[t_start] = 't'
                 if t_end < b_end:
                     ctls[t_end] = 'b'
 
     # (7) Mark data blocks of all zeroes with 's'
     for ctl, b_start, b_end in _get_blocks(ctls):
-        if ctl == 'b' and sum(snapshot[b_start:b_end]) == 0:
+        if ctl == 'b' and mem.count(0, b_start, b_end) == b_end - b_start:
             ctls[b_start] = 's'
 
     return ctls
 
-def _check_text(t_blocks, t_start, t_end, text, min_length, words):
-    if len(text) >= min_length:
+def _check_text(t_blocks, mem, t_start, t_end, min_length, words):
+    if t_end - t_start >= min_length:
         if words:
-            t_lower = text.lower()
+            t_lower = mem[t_start:t_end].decode('latin_1').lower()
             for word in words:
                 if word in t_lower:
                     break
@@ -290,31 +316,23 @@ def _check_text(t_blocks, t_start, t_end, text, min_length, words):
                 return
         t_blocks.append((t_start, t_end))
 
-def _get_text_blocks(snapshot, start, end, config, data=True):
+def _get_text_blocks(mem, start, end, config, data=True):
     if data:
         min_length = config.text_min_length_data
     else:
         min_length = config.text_min_length_code
     t_blocks = []
     if end - start >= min_length:
-        text = ''
-        for address in range(start, end):
-            char = chr(snapshot[address])
-            if char in config.text_chars:
-                if not text:
-                    t_start = address
-                text += char
-            elif text:
-                _check_text(t_blocks, t_start, address, text, min_length, config.words)
-                text = ''
-        if text:
-            _check_text(t_blocks, t_start, end, text, min_length, config.words)
+        text_bytes = bytes(sorted({ord(c) for c in config.text_chars if ord(c) < 256}))
+        if text_bytes:
+            for match in re.compile(b'[' + re.escape(text_bytes) + b']+').finditer(mem, start, end):
+                _check_text(t_blocks, mem, match.start(), match.end(), min_length, config.words)
     return t_blocks
 
-def _catch_data(ctls, ctl_addr, count, max_count, addr, op_bytes):
+def _catch_data(ctls, ctl_addr, count, max_count, addr, op_byte):
     if count >= max_count > 0:
         # A 2-instruction sequence ending with 'LD H,(HL)' or 'LD L,(HL)' is OK
-        if not (count == 2 and op_bytes[0] in (0x66, 0x6E)):
+        if not (count == 2 and op_byte in (0x66, 0x6E)):
             if not ctls or ctls[-1][1] != 'b':
                 ctls.append((ctl_addr, 'b'))
             return addr
@@ -323,30 +341,30 @@ def _catch_data(ctls, ctl_addr, count, max_count, addr, op_bytes):
 def _generate_ctls_without_code_map(snapshot, start, end, config):
     ctls = []
     ctl_addr = start
-    prev_max_count, prev_op_id, prev_op, prev_op_bytes = 0, None, None, ()
+    prev_max_count, prev_op_id, prev_op, prev_op_byte = 0, None, None, None
     count = 1
     for addr, size, max_count, op_id, operation in decode(snapshot, start, end):
-        op_bytes = snapshot[addr:addr + size]
         if op_id == END:
             # Catch data-like sequences that precede a terminal instruction
-            ctl_addr = _catch_data(ctls, ctl_addr, count, prev_max_count, addr, prev_op_bytes)
+            ctl_addr = _catch_data(ctls, ctl_addr, count, prev_max_count, addr, prev_op_byte)
             ctls.append((ctl_addr, 'c'))
             ctl_addr = addr + size
-            prev_max_count, prev_op_id, prev_op, prev_op_bytes = 0, None, None, ()
+            prev_max_count, prev_op_id, prev_op, prev_op_byte = 0, None, None, None
             count = 1
             continue
         if op_id == prev_op_id:
             count += 1
         elif prev_op:
-            ctl_addr = _catch_data(ctls, ctl_addr, count, prev_max_count, addr, prev_op_bytes)
+            ctl_addr = _catch_data(ctls, ctl_addr, count, prev_max_count, addr, prev_op_byte)
             count = 1
-        prev_max_count, prev_op_id, prev_op, prev_op_bytes = max_count, op_id, operation, op_bytes
+        prev_max_count, prev_op_id, prev_op, prev_op_byte = max_count, op_id, operation, snapshot[addr]
 
     if not ctls or ctls[-1][0] != ctl_addr:
         ctls.append((ctl_addr, 'b'))
     ctls.append((end, 'i'))
 
     ctls = dict(ctls)
+    mem = bytes(snapshot)
 
     # Mark a NOP sequence at the beginning of a code block as a zero block,
     # and mark a data block of all zeroes as a zero block
@@ -359,7 +377,7 @@ def _generate_ctls_without_code_map(snapshot, start, end, config):
                 if snapshot[address]:
                     ctls[address] = 'c'
                     break
-        elif set(snapshot[start:end]) == {0}:
+        elif mem.count(0, start, end) == end - start:
             ctls[start] = 's'
 
     # Join any adjacent data and zero blocks
@@ -377,12 +395,12 @@ def _generate_ctls_without_code_map(snapshot, start, end, config):
     for i in range(len(edges) - 1):
         start, end = edges[i], edges[i + 1]
         if ctls[start] == 'b':
-            for t_start, t_end in _get_text_blocks(snapshot, start, end, config):
+            for t_start, t_end in _get_text_blocks(mem, start, end, config):
                 ctls[t_start] = 't'
                 if t_end < end:
                     ctls[t_end] = 'b'
         elif ctls[start] == 'c':
-            text_blocks = _get_text_blocks(snapshot, start, end, config, False)
+            text_blocks = _get_text_blocks(mem, start, end, config, False)
             if text_blocks:
                 ctls[start] = 'b'
                 for t_start, t_end in text_blocks:
@@ -397,10 +415,9 @@ def _generate_ctls_without_code_map(snapshot, start, end, config):
 def write_ctl(ctls, ctl_hex):
     addr_fmt = get_address_format(ctl_hex, ctl_hex == 1)
     start = addr_fmt.format(min(ctls))
-    write_line('@ {} {}'.format(start, AD_START))
-    write_line('@ {} {}'.format(start, AD_ORG))
-    for address in [a for a in sorted(ctls) if a < 65536]:
-        write_line('{} {}'.format(ctls[address], addr_fmt.format(address)))
+    lines = ['@ {} {}'.format(start, AD_START), '@ {} {}'.format(start, AD_ORG)]
+    lines.extend('{} {}'.format(ctls[a], addr_fmt.format(a)) for a in sorted(ctls) if a < 65536)
+    write_text('\n'.join(lines) + '\n')
 
 def generate_ctls(snapshot, start, end, code_map, config):
     """Generate control directives from a snapshot.
@@ -175,7 +175,7 @@ Set a hardware state attribute. Recognised names and their default values are:
 """.format(', '.join(options)).strip())
 
 def make_z80_ram_block(data, page):
-    block = []
+    block = [0, 0, page]
     prev_b = None
     count = 0
     for b in data:
@@ -199,8 +199,9 @@ def make_z80_ram_block(data, page):
         block.extend((237, 237, count, prev_b))
     else:
         block.extend((prev_b,) * count)
-    length = len(block)
-    return [length % 256, length // 256, page] + block
+    length = len(block) - 3
+    block[:2] = (length % 256, length // 256)
+    return block
 
 def make_z80v3_ram_blocks(ram):
     blocks = []
@@ -214,7 +215,8 @@ def write_z80v3(fname, ram, registers, state):
     set_z80_registers(z80, 'i=63', 'iy=23610', *registers)
     set_z80_state(z80, 'iff=1', 'im=1', *state)
     with open(fname, 'wb') as f:
-        f.write(bytes(z80 + make_z80v3_ram_blocks(ram)))
+        f.write(bytes(z80))
+        f.write(bytes(make_z80v3_ram_blocks(ram)))
 
 def move(snapshot, param_str):
     params = param_str.split(',', 2)
@@ -243,6 +245,8 @@ def poke(snapshot, param_str):
             poke_f = lambda b: value
     except ValueError:
         raise SkoolKitError('Invalid value in poke spec: {}'.format(param_str))
+    if not val.startswith('+') and not 0 <= value < 256:
+        raise SkoolKitError('Invalid value in poke spec: {}'.format(param_str))
     try:
         values = [get_int_param(i, True) for i in addr.split('-', 2)]
     except ValueError:
@@ -14,9 +14,11 @@
 # You should have received a copy of the GNU General Public License along with
 # SkoolKit. If not, see <http://www.gnu.org/licenses/>.
 
+import re
 from collections import defaultdict, namedtuple
+from functools import lru_cache
 
-from skoolkit import (SkoolKitError, warn, write_line, wrap, parse_int,
+from skoolkit import (SkoolKitError, warn, write_text, wrap, parse_int,
                       get_address_format, format_template)
 from skoolkit.components import get_component, get_value
 from skoolkit.skoolasm import UDGTABLE_MARKER
@@ -30,9 +32,20 @@ from skoolkit.skoolparser import (get_address, parse_asm_refs_directive,
 MIN_COMMENT_WIDTH = 10
 AD_LABEL_PREFIX = AD_LABEL + '='
 AD_REFS_PREFIX = AD_REFS + '='
+END_MARKERS = {
+    TABLE_MARKER: TABLE_END_MARKER,
+    UDGTABLE_MARKER: TABLE_END_MARKER,
+    LIST_MARKER: LIST_END_MARKER
+}
+BLOCK_MARKER_RE = re.compile('|'.join(re.escape(m) for m in END_MARKERS))
+ASCII_TABLE = bytes(b if 32 <= b < 127 else 46 for b in range(256))
 
 DisassemblerConfig = namedtuple('DisassemblerConfig', 'asm_hex asm_lower defb_size defm_size defw_size')
 
+@lru_cache(maxsize=4096)
+def _wrap(text, width):
+    return tuple(wrap(text, width))
+
 def calculate_references(entries, operations):
     """
     For each entry point in each routine, calculate a list of the entries
@@ -252,6 +265,8 @@ class SkoolWriter:
         self.disassembly = Disassembly(snapshot, ctl_parser, config, self.asm_hex, options.case == 1)
         self.address_fmt = get_address_format(self.asm_hex, options.case == 1)
         self.config = config
+        self.lines = []
+        self.write_line = self.lines.append
 
     def address_str(self, address, pad=True):
         if self.asm_hex or pad:
@@ -268,17 +283,26 @@ class SkoolWriter:
     def write_skool(self, write_refs, text):
         for entry_index, entry in enumerate(self.disassembly.entries):
             if entry_index:
-                write_line('')
-            self._write_entry(entry, write_refs, text)
+                self.write_line('')
+            try:
+                self._write_entry(entry, write_refs, text)
+            finally:
+                self._flush()
+
+    def _flush(self):
+        if self.lines:
+            self.lines.append('')
+            write_text('\n'.join(self.lines))
+            self.lines.clear()
 
     def _write_entry(self, entry, write_refs, show_text):
         if entry.header:
             for line in entry.header:
-                write_line(line)
-            write_line('')
+                self.write_line(line)
+            self.write_line('')
 
         self.write_asm_directives(*entry.asm_directives)
-        self.write_asm_directives(entry.get_ignoreua_directive(TITLE))
+        self.write_asm_directive(entry.get_ignoreua_directive(TITLE))
 
         if entry.ctl == 'i' and entry.blocks[-1].end >= 65536 and not entry.has_title and all([b.ctl == 'i' for b in entry.blocks]):
             return
@@ -297,13 +321,13 @@ class SkoolWriter:
 
         self._write_body(entry, wrote_desc, write_refs, show_text and entry.ctl != 't')
 
-        self.write_asm_directives(entry.get_ignoreua_directive(END))
+        self.write_asm_directive(entry.get_ignoreua_directive(END))
         self.write_paragraphs(entry.end_comment)
 
         if entry.footer:
-            write_line('')
+            self.write_line('')
             for line in entry.footer:
-                write_line(line)
+                self.write_line(line)
 
     def _write_entry_description(self, entry, write_refs):
         wrote_desc = False
@@ -312,7 +336,7 @@ class SkoolWriter:
             referrers = entry.instructions[0].referrers
             if referrers and (write_refs == 2 or not entry.description):
                 self.write_comment('')
-                self.write_asm_directives(ignoreua_d)
+                self.write_asm_directive(ignoreua_d)
                 self.write_referrers(referrers, False)
                 wrote_desc = True
         if entry.description:
@@ -320,7 +344,7 @@ class SkoolWriter:
                 self._write_paragraph_separator()
             else:
                 self.write_comment('')
-                self.write_asm_directives(ignoreua_d)
+                self.write_asm_directive(ignoreua_d)
             self.write_paragraphs(entry.description)
             wrote_desc = True
         return wrote_desc
@@ -331,30 +355,31 @@ class SkoolWriter:
             if len(spec) == 1:
                 if spec[0]:
                     delimiters, reg, desc = parse_register(spec[0])
-                    registers.append((reg.join(delimiters), desc))
+                    reg = reg.join(delimiters)
+                    registers.append((reg, desc, reg.find(':')))
             elif self._trim_lines(spec):
-                registers.append(('', spec))
+                registers.append(('', spec, -1))
 
         entry.registers = registers
         if registers:
-            max_indent = max(r[0].find(':') for r in registers)
+            max_indent = max(r[2] for r in registers)
             if not wrote_desc:
                 self._write_empty_paragraph()
                 wrote_desc = True
             self.write_comment('')
-            self.write_asm_directives(entry.get_ignoreua_directive(REGISTERS))
-            for reg, desc in registers:
+            self.write_asm_directive(entry.get_ignoreua_directive(REGISTERS))
+            for reg, desc, colon in registers:
                 if reg:
-                    reg = reg.rjust(max_indent + len(reg) - reg.find(':'))
+                    reg = reg.rjust(max_indent + len(reg) - colon)
                     desc_indent = len(reg) + 1
-                    desc_lines = wrap(desc, max(self.comment_width - desc_indent, MIN_COMMENT_WIDTH)) or ['']
+                    desc_lines = _wrap(desc, max(self.comment_width - desc_indent, MIN_COMMENT_WIDTH)) or ('',)
                     desc_prefix = '.'.ljust(desc_indent)
-                    write_line('; {} {}'.format(reg, desc_lines[0]).rstrip())
+                    self.write_line('; {} {}'.format(reg, desc_lines[0]).rstrip())
                     for line in desc_lines[1:]:
-                        write_line('; {}{}'.format(desc_prefix, line).rstrip())
+                        self.write_line('; {}{}'.format(desc_prefix, line).rstrip())
                 else:
                     for line in desc:
-                        write_line('; {}'.format(line).rstrip())
+                        self.write_line('; {}'.format(line).rstrip())
 
         return wrote_desc
 
@@ -384,19 +409,20 @@ class SkoolWriter:
         if multi_line and len(block.comment) == 1 and not comment.replace('.', ''):
             comment = comment[1:]
             block.comment[0] = (0, comment)
-        if multi_line or comment.startswith('{'):
+        starts_brace = comment.startswith('{')
+        if multi_line or starts_brace:
             balance = comment.count('{') - comment.count('}')
             if multi_line and balance < 0:
                 opening = '{' * (1 - balance)
             else:
                 opening = '{'
-            if comment.startswith('{'):
+            if starts_brace:
                 opening = opening + ' '
             closing = '}' * max(1 + balance, 1)
             if comment.endswith('}'):
                 closing = ' ' + closing
         if len(block.comment) == 1:
-            block.comment[:] = [(0, t) for t in wrap(opening + block.comment[0][1], width)]
+            block.comment[:] = [(0, t) for t in _wrap(opening + block.comment[0][1], width)]
         elif block.comment:
             if not block.comment[0][1]:
                 block.comment.pop(0)
@@ -406,13 +432,18 @@ class SkoolWriter:
     def _write_body(self, entry, wrote_desc, write_refs, show_text):
         op_width = max((self.config['InstructionWidth'], entry.width()))
         comment_width = max(self.comment_width - op_width - 8, self.config['CommentWidthMin'])
+        write_asm_directive = self.write_asm_directive
+        format_instruction_comments = self._format_instruction_comments
+        set_instruction_comments = self._set_instruction_comments
+        write_instructions = self._write_instructions
+        code_refs = entry.ctl == 'c' and write_refs
         for index, block in enumerate(entry.blocks):
             ignoreua_m = block.get_ignoreua_directive(MID_BLOCK, block.start)
             begun_header = False
-            if index > 0 and entry.ctl == 'c' and write_refs:
+            if index > 0 and code_refs:
                 referrers = block.instructions[0].referrers
                 if referrers and (write_refs == 2 or not block.header):
-                    self.write_asm_directives(ignoreua_m)
+                    write_asm_directive(ignoreua_m)
                     self.write_referrers(referrers)
                     begun_header = True
             if block.header:
@@ -425,27 +456,38 @@ class SkoolWriter:
                 if begun_header:
                     self._write_paragraph_separator()
                 else:
-                    self.write_asm_directives(ignoreua_m)
+                    write_asm_directive(ignoreua_m)
                 self.write_paragraphs(block.header)
-            self._format_instruction_comments(block, comment_width, show_text)
-            self._write_instructions(entry, block, op_width, write_refs)
+            if block.comment:
+                format_instruction_comments(block, comment_width, show_text)
+            else:
+                set_instruction_comments(block, comment_width, '', show_text)
+            write_instructions(entry, block, op_width, write_refs)
 
     def _write_instructions(self, entry, block, op_width, write_refs):
+        address_str = self.address_str
+        write_line = self.write_line
+        ignoreua = block.ignoreua_directives
+        semicolons = entry.ctl in self.config['Semicolons']
+        code_refs = entry.ctl == 'c' and write_refs
+        comment_prefix = ' ' * (op_width + 7) + ' ; '
         for index, instruction in enumerate(block.instructions):
             ctl = instruction.ctl or ' '
             address = instruction.address
             operation = instruction.operation
             comment = instruction.comment.pop(0)
-            if index > 0 and entry.ctl == 'c' and ctl == '*' and write_refs:
+            if index > 0 and ctl == '*' and code_refs:
                 self.write_referrers(instruction.referrers)
-            self.write_asm_directives(*instruction.asm_directives)
-            self.write_asm_directives(block.get_ignoreua_directive(INSTRUCTION, instruction.address))
-            if entry.ctl in self.config['Semicolons'] or comment is not None:
-                write_line(('{}{} {:{}} ; {}'.format(ctl, self.address_str(address), operation, op_width, comment or '')).rstrip())
+            if instruction.asm_directives:
+                self.write_asm_directives(*instruction.asm_directives)
+            if address in ignoreua:
+                self.write_asm_directive(block.get_ignoreua_directive(INSTRUCTION, address))
+            if semicolons or comment is not None:
+                write_line((ctl + address_str(address) + ' ' + operation.ljust(op_width) + ' ; ' + (comment or '')).rstrip())
             else:
-                write_line(('{}{} {}'.format(ctl, self.address_str(address), operation)).rstrip())
+                write_line((ctl + address_str(address) + ' ' + operation).rstrip())
             for comment in instruction.comment:
-                write_line('       {:{}} ; {}'.format('', op_width, comment).rstrip())
+                write_line((comment_prefix + comment).rstrip())
 
     def write_comment(self, text, paragraphs=False):
         if isinstance(text, str):
@@ -456,11 +498,11 @@ class SkoolWriter:
             lines = self._trim_lines(text[:])
         for line in lines:
             if line:
-                write_line('; ' + line)
+                self.write_line('; ' + line)
             elif paragraphs:
                 self._write_paragraph_separator()
             else:
-                write_line(';')
+                self.write_line(';')
 
     def _write_empty_paragraph(self):
         self.write_comment('')
@@ -481,36 +523,38 @@ class SkoolWriter:
                 key = 'EntryPointRef'
             else:
                 key = 'Ref'
-            fields = {'ref': '#R' + self.address_str(referrers[-1], False)}
-            if len(referrers) > 1:
+            ref = '#R' + self.address_str(referrers[-1], False)
+            if len(referrers) == 1:
+                text = format_template(self.config[key], key, ref=ref)
+            else:
                 key += 's'
-                fields['refs'] = ', '.join(['#R' + self.address_str(r, False) for r in referrers[:-1]])
-            self.write_comment([format_template(self.config[key], key, **fields)])
+                refs = ', '.join(['#R' + self.address_str(r, False) for r in referrers[:-1]])
+                text = format_template(self.config[key], key, ref=ref, refs=refs)
+            self.write_comment([text])
+
+    def write_asm_directive(self, directive):
+        if directive:
+            self.write_line('@' + directive)
 
     def write_asm_directives(self, *directives):
         for directive in directives:
             if directive:
-                write_line('@' + directive)
+                self.write_line('@' + directive)
 
     def to_ascii(self, data):
-        chars = ['[']
-        for b in data:
-            if 32 <= b < 127:
-                chars.append(chr(b))
-            else:
-                chars.append('.')
-        chars.append(']')
-        return ''.join(chars)
+        return '[' + bytes(data).translate(ASCII_TABLE).decode('latin_1') + ']'
 
     def wrap(self, text):
+        if not BLOCK_MARKER_RE.search(text):
+            return list(_wrap(text.strip(), self.comment_width))
         lines = []
         for line, wrap_flag in self.parse_blocks(text):
             if wrap_flag == 0:
                 lines.append(line)
             elif wrap_flag == 1:
-                lines.extend(wrap(line, self.comment_width))
+                lines.extend(_wrap(line, self.comment_width))
             else:
-                block = wrap(line, self.comment_width)
+                block = _wrap(line, self.comment_width)
                 lines.append(block[0])
                 if len(block) > 1:
                     if block[0].endswith(' |'):
@@ -520,7 +564,7 @@ class SkoolWriter:
                     while indent < len(block[0]) and block[0][indent] == ' ':
                         indent += 1
                     pad = ' ' * indent
-                    lines.extend(pad + line for line in wrap(' '.join(block[1:]), self.comment_width - indent))
+                    lines.extend(pad + line for line in _wrap(' '.join(block[1:]), self.comment_width - indent))
         return lines
 
     def parse_block(self, text, begin):
@@ -557,30 +601,27 @@ class SkoolWriter:
         return indexes
 
     def parse_blocks(self, text):
-        markers = ((TABLE_MARKER, TABLE_END_MARKER), (UDGTABLE_MARKER, TABLE_END_MARKER), (LIST_MARKER, LIST_END_MARKER))
         indexes = []
 
         # Find table/list markers and row/item definitions
         index = 0
         while True:
-            starts = [(marker[0], marker[1], text.find(marker[0], index)) for marker in markers]
-            for marker, end_marker, start in starts:
-                if start >= 0:
-                    if start > 0:
-                        indexes.append((start - 1, 1))
-                    try:
-                        end = text.index(end_marker, start) + len(end_marker)
-                    except ValueError:
-                        raise SkoolKitError("No end marker found: {}...".format(text[start:start + len(marker) + 15]))
-                    indexes.extend(self.parse_block(text[:end], start + len(marker)))
-                    break
-            else:
+            match = BLOCK_MARKER_RE.search(text, index)
+            if not match:
                 break
+            start, marker = match.start(), match.group()
+            end_marker = END_MARKERS[marker]
+            if start > 0:
+                indexes.append((start - 1, 1))
+            try:
+                end = text.index(end_marker, start) + len(end_marker)
+            except ValueError:
+                raise SkoolKitError("No end marker found: {}...".format(text[start:start + len(marker) + 15]))
+            indexes.extend(self.parse_block(text[:end], start + len(marker)))
             index = indexes[-1][0] + 1
 
         if not indexes or indexes[-1][0] != len(text):
             indexes.append((len(text), 1))
-        indexes.sort(key=lambda e: e[0])
         lines = []
         start = 0
         for end, wrap_flag in indexes:
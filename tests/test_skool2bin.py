@@ -260,6 +260,20 @@ class BinWriterTest(BinWriterTestCase):
             self.run_skool2bin(skoolfile)
         self.assertEqual(cm.exception.args[0], 'Failed to assemble:\n 40000 XOR HL')
 
+    def test_relative_jump_out_of_range_after_tab(self):
+        skool = """
+            @org=32768
+            c32768 JR\t32770
+             32770 NOP
+             32771 JR\t32768
+             32773 DEFS 200
+             32973 JR\t32768
+        """
+        skoolfile = self.write_text_file(dedent(skool).strip(), suffix='.skool')
+        with self.assertRaises(SkoolKitError) as cm:
+            self.run_skool2bin(skoolfile)
+        self.assertEqual(cm.exception.args[0], 'Failed to assemble:\n 32973 JR\t32768')
+
     def test_skool_file_from_stdin(self):
         self.write_stdin('c49152 RET')
         self._test_write(None, 49152, [201])
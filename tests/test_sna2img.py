@@ -635,6 +635,7 @@ class Sna2ImgTest(SkoolKitTestCase):
         self._test_bad_spec('-p 1', 'Value missing in poke spec: 1')
         self._test_bad_spec('-p q', 'Value missing in poke spec: q')
         self._test_bad_spec('-p 1,x', 'Invalid value in poke spec: 1,x')
+        self._test_bad_spec('-p 1,256', 'Invalid value in poke spec: 1,256')
         self._test_bad_spec('-p x,1', 'Invalid address range in poke spec: x,1')
         self._test_bad_spec('-p 1-y,1', 'Invalid address range in poke spec: 1-y,1')
         self._test_bad_spec('-p 1-3-z,1', 'Invalid address range in poke spec: 1-3-z,1')
@@ -283,6 +283,9 @@ class SnapmodTest(SkoolKitTestCase):
         self._test_bad_spec('-p 1', infile, 'Value missing in poke spec: 1')
         self._test_bad_spec('-p q', infile, 'Value missing in poke spec: q')
         self._test_bad_spec('-p 1,x', infile, 'Invalid value in poke spec: 1,x')
+        self._test_bad_spec('-p 100,300', infile, 'Invalid value in poke spec: 100,300')
+        self._test_bad_spec('-p 32768,^256', infile, 'Invalid value in poke spec: 32768,^256')
+        self._test_bad_spec('-p 32768,-1', infile, 'Invalid value in poke spec: 32768,-1')
         self._test_bad_spec('-p x,1', infile, 'Invalid address range in poke spec: x,1')
         self._test_bad_spec('-p 1-y,1', infile, 'Invalid address range in poke spec: 1-y,1')
         self._test_bad_spec('-p 1-3-z,1', infile, 'Invalid address range in poke spec: 1-3-z,1')
@@ -1894,6 +1894,28 @@ class SkoolWriterTest(SkoolKitTestCase):
             with self.subTest(params=params):
                 self._test_write_skool(snapshot, ctl.format(params), exp_skool.format(params))
 
+    def test_list_followed_by_table(self):
+        snapshot = [0]
+        ctl = """
+            b 00000 Test list followed by table
+            D 00000 #LIST { Item 1 } { Item 2 } LIST# #TABLE { Row 1 } { Row 2 } TABLE#
+            i 00001
+        """
+        exp_skool = """
+            ; Test list followed by table
+            ;
+            ; #LIST
+            ; { Item 1 }
+            ; { Item 2 }
+            ; LIST#
+            ; #TABLE
+            ; { Row 1 }
+            ; { Row 2 }
+            ; TABLE#
+            b00000 DEFB 0
+        """
+        self._test_write_skool(snapshot, ctl, exp_skool)
+
     def test_list_without_closing_bracket_on_parameters(self):
         ctl = """
             b 00000
@@ -394,6 +394,7 @@ class Tap2SnaTest(SkoolKitTestCase):
         self._test_bad_spec('--ram poke=1', 'Value missing in poke spec: 1')
         self._test_bad_spec('--ram poke=q', 'Value missing in poke spec: q')
         self._test_bad_spec('--ram poke=1,x', 'Invalid value in poke spec: 1,x')
+        self._test_bad_spec('--ram poke=1,^256', 'Invalid value in poke spec: 1,^256')
         self._test_bad_spec('--ram poke=x,1', 'Invalid address range in poke spec: x,1')
         self._test_bad_spec('--ram poke=1-y,1', 'Invalid address range in poke spec: 1-y,1')
         self._test_bad_spec('--ram poke=1-3-z,1', 'Invalid address range in poke spec: 1-3-z,1')